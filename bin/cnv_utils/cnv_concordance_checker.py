@@ -46,133 +46,164 @@ python compare_cnv_calls.py \
 
 
 import argparse
-import pandas as pd
 import duckdb
 from pathlib import Path
 
+# Genomic bins of 2**17 bp (128 kb) used to restrict the interval join
+BIN_SHIFT = 17
 
-def load_data(file_path: Path) -> pd.DataFrame:
-    """Load TSV file into a DataFrame."""
-    print(f"[INFO] Loading data from {file_path} ...")
-    return pd.read_csv(file_path, sep="\t", low_memory=False)
 
+def load_data(con: duckdb.DuckDBPyConnection, file_path: Path, table: str) -> None:
+    """Parse TSV file with DuckDB into a table, whose built-in rowid numbers rows in file order."""
+    print(f"[INFO] Loading data from {file_path} ...")
+    # Only the mandatory columns are typed, the others stay text and are written back as read
+    con.execute(
+        f"""
+        CREATE TABLE {table} AS
+        SELECT *
+        FROM read_csv_auto(?, delim = '\\t', header = true, all_varchar = true,
+                           types = {{'SampleID': 'VARCHAR', 'Chr': 'VARCHAR', 'Type': 'VARCHAR',
+                                     'Start': 'BIGINT', 'End': 'BIGINT'}})
+        """,
+        [str(file_path)],
+    )
 
-def add_row_ids(df: pd.DataFrame) -> pd.DataFrame:
-    """Add a unique row identifier column."""
-    df["rowid"] = range(len(df))
-    df
-    return df
 
+def flag_overlaps(con: duckdb.DuckDBPyConnection) -> None:
+    """Store the pairs of CNVs from df_a and df_b with reciprocal overlap >= 50%.
 
-def flag_overlaps(con: duckdb.DuckDBPyConnection) -> pd.DataFrame:
-    """Find reciprocal overlaps >= 50% between df_a and df_b."""
-    query = """
-    WITH overlaps_df AS (
+    CNVs are expanded over the fixed-size genomic bins they cover so the join
+    only compares intervals sharing a bin, instead of every pair of CNVs with
+    the same SampleID, Chr and Type.
+    """
+    query = f"""
+    CREATE TEMP TABLE overlap_pairs AS
+    WITH bins_a AS (
+      SELECT t.rowid, t.SampleID, t.Chr, t.Type, t.Start, t.End,
+             unnest(range(CAST(t.Start AS BIGINT) >> {BIN_SHIFT},
+                          (CAST(t.End - 1 AS BIGINT) >> {BIN_SHIFT}) + 1)) AS bin
+      FROM df_a AS t
+      WHERE t.End > t.Start
+    ),
+    bins_b AS (
+      SELECT t.rowid, t.SampleID, t.Chr, t.Type, t.Start, t.End,
+             unnest(range(CAST(t.Start AS BIGINT) >> {BIN_SHIFT},
+                          (CAST(t.End - 1 AS BIGINT) >> {BIN_SHIFT}) + 1)) AS bin
+      FROM df_b AS t
+      WHERE t.End > t.Start
+    ),
+    overlaps_df AS (
       SELECT 
-        df_a.rowid AS id_a,
-        df_b.rowid AS id_b,
-        df_a.SampleID AS SampleID_a,
-        df_b.SampleID AS SampleID_b,
-        df_a.Chr,
-        GREATEST(df_a.Start, df_b.Start) AS overlap_start,
-        LEAST(df_a.End, df_b.End) AS overlap_end,
-        (LEAST(df_a.End, df_b.End) - GREATEST(df_a.Start, df_b.Start)) AS overlap_len,
-        (df_a.End - df_a.Start) AS len_a,
-        (df_b.End - df_b.Start) AS len_b
-      FROM df_a
-      JOIN df_b
-        ON df_a.Chr = df_b.Chr
-        AND df_a.SampleID = df_b.SampleID
-        AND df_a.Type = df_b.Type
-        AND df_a.End > df_b.Start
-        AND df_a.Start < df_b.End
+        a.rowid AS id_a,
+        b.rowid AS id_b,
+        (LEAST(a.End, b.End) - GREATEST(a.Start, b.Start)) AS overlap_len,
+        (a.End - a.Start) AS len_a,
+        (b.End - b.Start) AS len_b
+      FROM bins_a a
+      JOIN bins_b b
+        ON a.Chr = b.Chr
+        AND a.SampleID = b.SampleID
+        AND a.Type = b.Type
+        AND a.bin = b.bin
+        AND a.End > b.Start
+        AND a.Start < b.End
+      -- an overlapping pair shares every bin of its overlap; keep only the first one
+      WHERE a.bin = CAST(GREATEST(a.Start, b.Start) AS BIGINT) >> {BIN_SHIFT}
     )
-    SELECT
-      id_a,
-      id_b,
-      CAST(
-        (overlap_len >= 0.5 * len_a AND overlap_len >= 0.5 * len_b) AS INTEGER
-      ) AS reciprocal_overlap_flag
+    SELECT id_a, id_b
     FROM overlaps_df
     WHERE overlap_len > 0
+      AND overlap_len >= 0.5 * len_a
+      AND overlap_len >= 0.5 * len_b
     """
-    return con.execute(query).df()
-
+    con.execute(query)
+
+
+def annotate(con: duckdb.DuckDBPyConnection, table: str, other: str, id_col: str, gene_match: bool) -> str:
+    """Materialize `table` with its CNV and gene overlap flags against `other`, in input order."""
+    out = f"{table}_out"
+    if gene_match:
+        gene_flag = f"""CAST(EXISTS (
+             SELECT 1 FROM {other}
+             WHERE {other}.SampleID = {table}.SampleID
+               AND {other}.Type = {table}.Type
+               AND {other}.Gene_ID = {table}.Gene_ID
+           ) AS INTEGER)"""
+    else:
+        gene_flag = "CAST(NULL AS INTEGER)"
 
-def flag_gene_matches(con: duckdb.DuckDBPyConnection, table_a: str, table_b: str, id_col: str) -> pd.DataFrame:
-    """Check if (SampleID, Gene_ID) exists in the other table."""
     query = f"""
-    SELECT {table_a}.rowid AS {id_col},
-           CASE WHEN {table_b}.rowid IS NOT NULL THEN 1 ELSE 0 END AS gene_based_overlap
-    FROM {table_a}
-    LEFT JOIN {table_b}
-      ON {table_a}.SampleID = {table_b}.SampleID
-      AND {table_a}.Type = {table_b}.Type
-      AND {table_a}.Gene_ID = {table_b}.Gene_ID
+    CREATE TEMP TABLE {out} AS
+    SELECT {table}.*,
+           CAST(EXISTS (
+             SELECT 1 FROM overlap_pairs WHERE overlap_pairs.{id_col} = {table}.rowid
+           ) AS INTEGER) AS CNV_based_overlap,
+           {gene_flag} AS gene_based_overlap
+    FROM {table}
+    ORDER BY {table}.rowid
     """
-    return con.execute(query).df()
+    con.execute(query)
+    return out
 
-def print_summary(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a: str, name_b: str):
+
+def print_summary(con: duckdb.DuckDBPyConnection, table_a: str, table_b: str, name_a: str, name_b: str):
     """Print summary statistics."""
     print("\n=== SUMMARY ===")
-    for name, df in [(name_a, df_a), (name_b, df_b)]:
-        total = len(df)
-        ovlp = df["CNV_based_overlap"].sum()
-        gene = df["gene_based_overlap"].sum() if df["gene_based_overlap"].notna().any() else 0
-        both = ((df["CNV_based_overlap"] == 1) & (df["gene_based_overlap"] == 1)).sum() if df["gene_based_overlap"].notna().any() else 0
+    for name, table in [(name_a, table_a), (name_b, table_b)]:
+        total, ovlp, gene, both = con.execute(f"""
+        SELECT count(*),
+               COALESCE(sum(CNV_based_overlap), 0),
+               sum(gene_based_overlap),
+               sum(CAST(CNV_based_overlap = 1 AND gene_based_overlap = 1 AS INTEGER))
+        FROM {table}
+        """).fetchone()
 
         print(f"{name}: {total} CNVs")
         print(f"  CNV-overlap: {ovlp} ({ovlp / total * 100:.2f}%)")
-        if df["gene_based_overlap"].notna().any():
+        if gene is not None:
             print(f"  Gene-overlap: {gene} ({gene / total * 100:.2f}%)")
             print(f"  Both overlap types: {both} ({both / total * 100:.2f}%)")
         print()
 
 
-def main(file_a: Path, file_b: Path, out_a: Path, out_b: Path):
-    # Load data
-    df_a = add_row_ids(load_data(file_a))
-    df_b = add_row_ids(load_data(file_b))
+def save_results(con: duckdb.DuckDBPyConnection, table: str, out_path: Path):
+    """Write `table` to a TSV file."""
+    path = str(out_path).replace("'", "''")
+    con.execute(f"""
+    COPY {table}
+    TO '{path}' (DELIMITER '\\t', HEADER TRUE)
+    """)
 
-    # Connect to DuckDB
+
+def main(file_a: Path, file_b: Path, out_a: Path, out_b: Path):
+    # Connect to DuckDB and load data
     con = duckdb.connect()
-    con.register("df_a", df_a)
-    con.register("df_b", df_b)
+    # rowid follows insertion order, so keep the CSV reader inserting rows in file order
+    con.execute("SET preserve_insertion_order = true")
+    load_data(con, file_a, "df_a")
+    load_data(con, file_b, "df_b")
 
     # Flag overlaps
     print("[INFO] Computing reciprocal overlaps >= 50% ...")
-    overlaps_df = flag_overlaps(con)
-    df_a["CNV_based_overlap"] = 0
-    df_b["CNV_based_overlap"] = 0
-    df_a.loc[overlaps_df.loc[overlaps_df["reciprocal_overlap_flag"] == 1, "id_a"].unique(), "CNV_based_overlap"] = 1
-    df_b.loc[overlaps_df.loc[overlaps_df["reciprocal_overlap_flag"] == 1, "id_b"].unique(), "CNV_based_overlap"] = 1
+    flag_overlaps(con)
 
     # Flag gene matches if Gene_ID column exists in both
-    if "Gene_ID" in df_a.columns and "Gene_ID" in df_b.columns:
+    gene_match = "Gene_ID" in con.table("df_a").columns and "Gene_ID" in con.table("df_b").columns
+    if gene_match:
         print("[INFO] Checking gene overlaps ...")
-        gene_flag_a = flag_gene_matches(con, "df_a", "df_b", "id_a")
-        df_a["gene_based_overlap"] = 0
-        df_a.loc[gene_flag_a.loc[gene_flag_a["gene_based_overlap"] == 1, "id_a"], "gene_based_overlap"] = 1
-
-        gene_flag_b = flag_gene_matches(con, "df_b", "df_a", "id_b")
-        df_b["gene_based_overlap"] = 0
-        df_b.loc[gene_flag_b.loc[gene_flag_b["gene_based_overlap"] == 1, "id_b"], "gene_based_overlap"] = 1
     else:
         print("[INFO] Skipping gene overlap check (Gene_ID column missing in one or both files)")
-        df_a["gene_based_overlap"] = pd.NA
-        df_b["gene_based_overlap"] = pd.NA
 
-    # Summary
-    print_summary(df_a, df_b, "File A", "File B")
+    out_table_a = annotate(con, "df_a", "df_b", "id_a", gene_match)
+    out_table_b = annotate(con, "df_b", "df_a", "id_b", gene_match)
 
-    # Drop internal rowid before saving
-    df_a = df_a.drop(columns=["rowid"])
-    df_b = df_b.drop(columns=["rowid"])
+    # Summary
+    print_summary(con, out_table_a, out_table_b, "File A", "File B")
 
     # Save results
     print(f"[INFO] Saving results to {out_a} and {out_b} ...")
-    df_a.to_csv(out_a, sep="\t", index=False)
-    df_b.to_csv(out_b, sep="\t", index=False)
+    save_results(con, out_table_a, out_a)
+    save_results(con, out_table_b, out_b)
     print("[INFO] Done.")
 
 
@@ -8,27 +8,24 @@
 # Description:
 # This pipeline analyzes the inheritance of CNVs (Copy Number Variants) 
 # in trio datasets. It filters CNVs based on pedigree information, 
-# constructs parent–child mappings, performs overlap checks with bedtools, 
-# and outputs an annotated child CNV table.
+# constructs parent–child mappings, computes reciprocal overlaps between
+# child and parent CNVs, and outputs an annotated child CNV table.
 #
 # Requirements:
 # - Python packages: polars, pyarrow
-# - External tools: zcat, awk, bedtools
 #
 # Input:
 # - CNV file (.tsv.gz or .parquet file)
 # - Pedigree file (tab-separated: SampleID, FatherID, MotherID)
 #
 # Output:
-# - Annotated child CNV BED and TSV files
+# - Annotated child CNV TSV file
 # =============================================================================
 
 
 import polars as pl
-import os
 import argparse
 from pathlib import Path
-import subprocess
 pl.enable_string_cache()
 
 # ------------------- Parse Arguments -------------------
@@ -79,204 +76,136 @@ elif ".tsv" not in suffix:
 # ------------------- Filter CNV Calls -------------------
 
 # +
-family_info = pl.scan_csv(PEDIGREE_FILE, separator="\t",infer_schema_length=100000)
+#sample IDs are dictionary-encoded (Categorical, shared string cache) so joins and filters on them compare integer codes
+#only the trio columns are used, all read as strings, so no schema inference pass is needed
+family_info = pl.scan_csv(PEDIGREE_FILE, separator="\t",
+                          schema_overrides={"SampleID": pl.Categorical,
+                                            "FatherID": pl.Categorical,
+                                            "MotherID": pl.Categorical},
+                          infer_schema_length=0).select("SampleID", "FatherID", "MotherID")
+
+#explicit dtypes for the columns the pipeline relies on, only the remaining columns are inferred
+cnv_schema = {"SampleID": pl.Categorical,
+              "Chr": pl.Categorical,
+              "Start": pl.Int64,
+              "End": pl.Int64}
+if TYPE_COL:
+    cnv_schema[f"{TYPE_COL}"] = pl.Categorical
 
 #load CNV lazily
+if tsv_mode:
+    df_cnv = pl.scan_csv(FILE_CNV, 
+                         separator = "\t", 
+                         schema_overrides=cnv_schema,infer_schema_length=100000)
+    print(f"Loading {FILE_CNV} in tsv mode")
+#casting to categorical for performance 
+else:
+    df_cnv = pl.scan_parquet(FILE_CNV)
+    df_cnv = df_cnv.with_columns([pl.col(col).cast(pl.Utf8).cast(dtype) if dtype == pl.Categorical
+                                  else pl.col(col).cast(dtype)
+                                  for col, dtype in cnv_schema.items()])
+    print(f"Loading {FILE_CNV} in parquet mode")
+
 if TYPE_COL:
-    if tsv_mode:
-        df_cnv = pl.scan_csv(FILE_CNV, 
-                             separator = "\t", 
-                             schema_overrides={f"{TYPE_COL}": pl.Categorical, 
-                                           "Chr": pl.Categorical},infer_schema_length=100000)
-        print(f"Loading {FILE_CNV} in tsv mode and using {TYPE_COL} as type column")
-    #casting to categorical for performance 
-    else:
-        df_cnv = pl.scan_parquet(FILE_CNV)
-        df_cnv = df_cnv.with_columns(pl.col(f"{TYPE_COL}").cast(pl.Categorical),
-                                     pl.col("Chr").cast(pl.Categorical))
-        print(f"Loading {FILE_CNV} in parquet mode and using {TYPE_COL} as type column")
+    print(f"Using {TYPE_COL} as type column")
 else:
-    if tsv_mode:
-        print(f"Loading {FILE_CNV} in tsv mode without type column")
-        df_cnv = pl.scan_csv(FILE_CNV, 
-                             separator = "\t", 
-                             schema_overrides={"Chr": pl.Categorical},infer_schema_length=100000)
-    else:
-        print(f"Loading {FILE_CNV} in parquet mode and without type column")
-        df_cnv = pl.scan_parquet(FILE_CNV)
-        df_cnv = df_cnv.with_columns(pl.col("Chr").cast(pl.Categorical))
-        
+    print("No type column given, CNVs are compared regardless of type")
+
+print("Filtering CNVs for samples found in the pedigree...")
+
+#the filter is pushed down into the scan, so CNVs of samples outside the pedigree are never materialized
+pedigree_ids = pl.concat([family_info.select(pl.col(col).alias("SampleID"))
+                          for col in ["SampleID", "FatherID", "MotherID"]]).unique().collect().to_series()
+#the input is parsed once into Arrow memory and shared by the child and parent branches,
+#instead of re-reading (and for .tsv.gz, re-decompressing) the file for each of them
+df_cnv = df_cnv.filter(pl.col("SampleID").is_in(pedigree_ids.implode())).collect(engine = "streaming").lazy()
 
 print("Filtering for trios that are completely found in the cnv table...")
 
 #keep only trios that have CNVs for every member 
-sample_ids = df_cnv.select(pl.col("SampleID")).unique().collect().to_series()                         
-family_trios =  family_info.filter(
-    pl.col("SampleID").is_in(sample_ids.implode()) & #adding implodes as per https://github.com/pola-rs/polars/pull/22178
-    pl.col("FatherID").is_in(sample_ids.implode()) &
-    pl.col("MotherID").is_in(sample_ids.implode())
+sample_tbl = df_cnv.select(pl.col("SampleID")).unique()
+family_trios = (family_info
+                .join(sample_tbl, on = "SampleID", how = "semi")
+                .join(sample_tbl.rename({"SampleID": "FatherID"}), on = "FatherID", how = "semi")
+                .join(sample_tbl.rename({"SampleID": "MotherID"}), on = "MotherID", how = "semi")
 )
 
 
 
 # +
-print("Building bed files...")
+print("Splitting child and parent CNVs...")
 
 #child cnvs subset from those available from pedigree file 
 df_child = df_cnv.join(family_trios, on = "SampleID", how = "inner")
-#father cnvs 
-df_father = df_cnv.join(family_trios, left_on = "SampleID", 
-                                     right_on = "FatherID", 
-                                     suffix = ".child", 
-                                     how = "inner")
-#mother cnvs
-df_mother = df_cnv.join(family_trios, left_on = "SampleID", 
-                                     right_on = "MotherID", 
-                                     suffix = ".child", 
-                                     how = "inner")
-
-
-#reorder to put child ID to front and drop parent IDs
-standard_col = ["SampleID.child","Chr","Start","End"] 
-f_order = standard_col + [col for col in df_father.collect_schema().names() if col not in standard_col]
-m_order = standard_col + [col for col in df_mother.collect_schema().names() if col not in standard_col]
-df_parents = pl.concat([df_father.select(f_order).drop("MotherID","SampleID"), 
-                        df_mother.select(m_order).drop("FatherID", "SampleID")])
-
-#build ID column for bedtools with concatentated groups (ie: Chr and type)
-if TYPE_COL is not None:
-
-    parents_out = df_parents.with_columns(pl.concat_str([pl.col("SampleID.child"),
-                                                         pl.lit("_"),
-                                                         pl.col("Chr"), 
-                                                         pl.lit("_"), 
-                                                         pl.col(f"{TYPE_COL}")])
-                                          .alias("SampleID")).select("SampleID","Start","End")
-
-    child_out = df_child.with_columns(pl.concat_str([pl.col("SampleID"),
-                                                     pl.lit("_"),
-                                                     pl.col("Chr"), 
-                                                     pl.lit("_"), 
-                                                     pl.col(f"{TYPE_COL}")])
-                                          .alias("SampleID")).select("SampleID","Start","End")
 
-else:
-
-    parents_out = df_parents.with_columns(pl.concat_str([pl.col("SampleID.child"),
-                                                         pl.lit("_"),
-                                                         pl.col("Chr"), 
-                                                         pl.lit("_")
-                                                        ])
-                                          .alias("SampleID")).select("SampleID","Start","End")
-
-    child_out = df_child.with_columns(pl.concat_str([pl.col("SampleID"),
-                                                     pl.lit("_"),
-                                                     pl.col("Chr"), 
-                                                     pl.lit("_") 
-                                                     ])
-                                      .alias("SampleID")).select("SampleID","Start","End")
-
-#print out as bed files
-child_bed = f"child_cnv.bed"
-parent_bed = f"parents_cnv.bed"
-
-child_out.sink_csv(child_bed, separator = "\t", include_header = False)
-parents_out.sink_csv(parent_bed, separator = "\t", include_header = False)
+#parent -> child links, one row per parent of each trio
+parent_links = pl.concat([family_trios.select(pl.col(parent).alias("SampleID"),
+                                              pl.col("SampleID").alias("SampleID.child"))
+                          for parent in ["FatherID", "MotherID"]])
 
+#parent cnvs keyed by the child they are compared to, in a single join
+df_parents = df_cnv.join(parent_links, on = "SampleID", how = "inner")
 
 # -
 
-# ------------------- Run bedtools intersect -------------------
-
-for ovlap in OVERLAPS:
-    bash_cmd = f"bedtools intersect -a {child_bed} -b {parent_bed} -f {ovlap} -r -wa -u > intersect_ovlap{ovlap}.bed;\
-bedtools intersect -a {child_bed} -b {parent_bed} -f {ovlap} -r -v > non_intersect_ovlap{ovlap}.bed"
-    print("Running command:\n", bash_cmd)
-    subprocess.run(bash_cmd, shell=True, check=True)
+# ------------------- Compute reciprocal overlaps -------------------
 
 # +
-print("Formatting intersections and combining results...")
-
-#load non-intersects and intersects and add the overlap columns, all false for non-overlap and vice-versa
-ovl_count = len(OVERLAPS)
-count = 0
-#for multiple overlap attempts we need to build a single table using multiple joins
-while count < ovl_count:
-    #for the first file no join needed 
-    if(count == 0):
-        non_intersects_file = pl.scan_csv(f"non_intersect_ovlap{OVERLAPS[count]}.bed", 
-                                          separator = "\t", has_header = False,infer_schema_length=100000)
-        #all false from non-interesects
-        non_intersects = non_intersects_file.with_columns(pl.lit(False)
-                                                          .alias(f"Observed_in_Parent_{OVERLAPS[count]}"))
-        #all true from intersects
-        intersects_file = pl.scan_csv(f"intersect_ovlap{OVERLAPS[count]}.bed", separator = "\t", has_header = False,infer_schema_length=100000)
-        intersects = intersects_file.with_columns(pl.lit(True).alias(f"Observed_in_Parent_{OVERLAPS[count]}"))
-        
-        count += 1
-    else:
-        #non-intersects
-        non_intersects_file = pl.scan_csv(f"non_intersect_ovlap{OVERLAPS[count]}.bed", 
-                                          separator = "\t", has_header = False,infer_schema_length=100000)
-        
-        non_intersects_file = non_intersects_file.with_columns(pl.lit(False)
-                                                          .alias(f"Observed_in_Parent_{OVERLAPS[count]}"))
-        #join on all matching columns to add new intersect column
-        non_intersects = non_intersects.join(non_intersects_file, on = ["column_1","column_2","column_3"])
-
-        
-        #intersects file
-        intersects_file = pl.scan_csv(f"intersect_ovlap{OVERLAPS[count]}.bed", 
-                                      separator = "\t", has_header = False,infer_schema_length=100000)
-        
-        intersects_file = intersects_file.with_columns(pl.lit(True).alias(f"Observed_in_Parent_{OVERLAPS[count]}"))
-        intersects = intersects.join(intersects_file, on = ["column_1","column_2","column_3"])
-        count += 1
-        
-
-
-#concat the two files
-lookup = pl.concat([intersects, non_intersects])
-
-
-lookup_id_fields  = ["SampleID", "Chr"]
-new_lookup_cols = ["SampleID", "Chr", "Start", "End"]
+print("Computing reciprocal overlaps between child and parent CNVs...")
 
+#CNVs are only compared within the same child, chromosome and type
+overlap_keys = ["SampleID", "Chr"]
 if TYPE_COL:
-    lookup_id_fields += [f"{TYPE_COL}"]
-    new_lookup_cols += [f"{TYPE_COL}"]
-
-#print(new_lookup_cols)
-#reformat and deconstruct the id field
-lookup = (lookup.with_columns(
-            pl.col("column_1")
-            .str.split_exact("_", 2)
-            .struct.rename_fields(lookup_id_fields)
-            .alias("ID_fields")
-    ).unnest("ID_fields").drop("column_1")
-)
-
+    overlap_keys += [f"{TYPE_COL}"]
 
-lookup_dict = {"column_2" : "Start", "column_3" : "End"}
-lookup = lookup.rename(lookup_dict)
+#materialized once so that hits and result share the same cnv_id
+df_child = df_child.with_row_index("cnv_id").collect().lazy()
 
+#genomic bins of 2**17 bp (128 kb): each CNV is expanded over the bins it covers so the
+#join only pairs child and parent CNVs sharing a bin, instead of every pair on a chromosome
+BIN_SIZE = 2 ** 17
 
+child_bins = (df_child.select(["cnv_id", "Start", "End"] + overlap_keys)
+              .filter(pl.col("End") > pl.col("Start"))
+              .with_columns(pl.int_ranges(pl.col("Start") // BIN_SIZE,
+                                          (pl.col("End") - 1) // BIN_SIZE + 1).alias("bin"))
+              .explode("bin")
+)
 
-if TYPE_COL:
-    #cast back to make the next join work
-    lookup = lookup.with_columns(pl.col("Chr").cast(pl.Categorical),
-                                 pl.col(f"{TYPE_COL}").cast(pl.Categorical))
-else:
-    lookup = lookup.with_columns(pl.col("Chr").cast(pl.Categorical))
+parents_bins = (df_parents.select([pl.col("SampleID.child").alias("SampleID")] +
+                                  overlap_keys[1:] +
+                                  [pl.col("Start").alias("Start.parent"),
+                                   pl.col("End").alias("End.parent")])
+                .filter(pl.col("End.parent") > pl.col("Start.parent"))
+                .with_columns(pl.int_ranges(pl.col("Start.parent") // BIN_SIZE,
+                                            (pl.col("End.parent") - 1) // BIN_SIZE + 1).alias("bin"))
+                .explode("bin")
+)
 
-#Make sure the SampleID in the Child CNVs df is string to match with original child cnv dataframe
-df_child  = df_child.with_columns(pl.col("SampleID").cast(pl.Utf8))
+#reciprocal overlap of a pair is the overlap length over the longest of the two CNVs,
+#so a child CNV is observed at fraction f if its best pair reaches f
+hits = (child_bins
+        .join(parents_bins, on = overlap_keys + ["bin"], how = "inner")
+        #an overlapping pair shares every bin of its overlap, keep it only on the first one
+        .filter(pl.col("bin") == pl.max_horizontal("Start", "Start.parent") // BIN_SIZE)
+        .with_columns((pl.min_horizontal("End", "End.parent") -
+                       pl.max_horizontal("Start", "Start.parent")).alias("overlap_len"))
+        .filter(pl.col("overlap_len") > 0)
+        .group_by("cnv_id")
+        .agg((pl.col("overlap_len") /
+              pl.max_horizontal(pl.col("End") - pl.col("Start"),
+                                pl.col("End.parent") - pl.col("Start.parent")))
+             .max().alias("reciprocal_overlap"))
+)
 
+print("Combining results...")
 
-#perform join on child CNV columns 
-result = df_child.join(lookup, on = new_lookup_cols,
-                               how = "inner",
-                               coalesce=True)
+#one column per requested overlap fraction, all false for CNVs without any parent hit
+result = (df_child.join(hits, on = "cnv_id", how = "left")
+          .with_columns([(pl.col("reciprocal_overlap").fill_null(0) >= ovlap)
+                         .alias(f"Observed_in_Parent_{ovlap}") for ovlap in OVERLAPS])
+          .drop("cnv_id", "reciprocal_overlap")
+)
 
 
 #reorder for final output 
@@ -300,16 +229,3 @@ print("Pipeline completed successfully.")
 
 print(f"💾 Results written to {OUTPUT}")
 
-
-# --------------------- Cleanup Temporary Files ---------------------
-files_to_remove = [
-    parent_bed,
-    child_bed
-] + [f"intersect_ovlap{ov}.bed" for ov in OVERLAPS] + [f"non_intersect_ovlap{ov}.bed" for ov in OVERLAPS]
-
-for f in files_to_remove:
-    try:
-        os.remove(f)
-        print(f"🗑️ Removed {f}")
-    except FileNotFoundError:
-        print(f"⚠️ Skipped {f} (not found)")